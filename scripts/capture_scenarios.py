@@ -1,94 +1,301 @@
 #!/usr/bin/env python3
 import argparse
+import http.client
 import json
 import os
+import selectors
+import shutil
 import signal
+import socket
 import subprocess
 import sys
 import threading
 import time
-from dataclasses import dataclass
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlencode
 
 import tomllib
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-@dataclass
-class InspectRecord:
-    event_index: int
-    timeNano: Optional[int]
-    id: str
-    action: str
-    inspect: Dict[str, Any]
 
+def json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
+
+def json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+# Timeout for inspect requests and for the event stream handshake.
+DOCKER_TIMEOUT = 10.0
+
+# Events for the same container within this window share one inspect.
+INSPECT_TTL = 0.02
+INSPECT_WORKERS = 8
+WRITE_BUFFER_SIZE = 1 << 16
+# The monitor never inspects on exec events, so they are recorded without an
+# inspect unless --inspect-all. Every other action keeps one: the replay mock
+# hands out inspects in order per container, so a missing record would shift
+# all later ones.
+SKIP_INSPECT_PREFIX = "exec_"
+# Actions that always trigger a fresh inspect; others may reuse a cached one.
+# health_status and oom follow healthcheck execs within milliseconds, and the
+# monitor reads the new health/OOM state from their inspect.
+REFRESH_ACTIONS = {"create", "start", "die", "destroy", "rename", "restart", "health_status", "oom"}
+
+
+def _unix_socket_path(host: str, source: str) -> str:
+    if not host.startswith("unix://"):
+        raise RuntimeError(f"{source} is {host!r}; the capture script only supports unix:// daemon sockets")
+    return host[len("unix://") :]
+
+
+@lru_cache(maxsize=None)
+def docker_socket_path() -> str:
+    # Resolve the daemon the same way the docker CLI used by run_cmd does, so
+    # containers, events and inspects all come from one daemon.
+    host = os.environ.get("DOCKER_HOST", "")
+    if host:
+        return _unix_socket_path(host, "DOCKER_HOST")
+    result = run_cmd(["docker", "context", "inspect", "--format", "{{.Endpoints.docker.Host}}"], check=False)
+    host = result.stdout.strip().decode()
+    if result.returncode == 0 and host:
+        return _unix_socket_path(host, "the active docker context endpoint")
+    return DOCKER_SOCKET
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+# http.client connections are not thread-safe, so each inspect worker keeps its own.
+_docker_local = threading.local()
+
+
+def docker_conn() -> UnixHTTPConnection:
+    conn = getattr(_docker_local, "conn", None)
+    if conn is None:
+        conn = UnixHTTPConnection(docker_socket_path(), timeout=DOCKER_TIMEOUT)
+        _docker_local.conn = conn
+    return conn
+
+
+def partial_path(path: Path) -> Path:
+    return path.with_name(path.name + ".partial")
+
+
+# Container name and lowercased action, the fields wait_for matches on.
+EventKey = Tuple[str, str]
+
+
+def event_key(event: Dict[str, Any]) -> EventKey:
+    name = event.get("Actor", {}).get("Attributes", {}).get("name", "")
+    return name.lstrip("/"), event.get("Action", "").lower()
+
+
+# The stream loop is the only producer and the scenario thread, via wait_for,
+# the only consumer, so the hand-off needs no lock.
 class EventRecorder:
-    def __init__(self) -> None:
-        self._lock = threading.Lock()
-        self._cond = threading.Condition(self._lock)
-        self.events: List[Dict[str, Any]] = []
-        self.inspects: List[InspectRecord] = []
-
-    def append(self, event: Dict[str, Any], inspect: Optional[Dict[str, Any]]) -> int:
-        with self._cond:
-            index = len(self.events)
-            self.events.append(event)
-            if inspect is not None:
-                self.inspects.append(
-                    InspectRecord(
-                        event_index=index,
-                        timeNano=event.get("timeNano"),
-                        id=event.get("Actor", {}).get("ID", ""),
-                        action=event.get("Action", ""),
-                        inspect=inspect,
-                    )
-                )
-            self._cond.notify_all()
-            return index
+    def __init__(self, events_path: Path, inspects_path: Path) -> None:
+        self._count = 0
+        self._closed = False
+        # Records are streamed to temporary files that close() moves into place.
+        self._paths = [events_path, inspects_path]
+        events_path.parent.mkdir(parents=True, exist_ok=True)
+        self._events_fp = partial_path(events_path).open("wb", buffering=WRITE_BUFFER_SIZE)
+        self._inspects_fp = partial_path(inspects_path).open("wb", buffering=WRITE_BUFFER_SIZE)
+        # Hand-off from producer to consumer; deque append/popleft are thread-safe.
+        self._queue: Deque[Tuple[int, EventKey]] = deque()
+        self._new = threading.Event()
+        # Set by the producer when the stream loop dies; wait_for re-raises it.
+        self._error: Optional[BaseException] = None
+        # Event indices per (container name, action), in ascending order. Owned by the consumer.
+        self._by_key: Dict[EventKey, List[int]] = {}
+
+    def append(
+        self,
+        event: Dict[str, Any],
+        raw_event: bytes,
+        raw_inspect: Optional[bytes],
+        key: Optional[EventKey] = None,
+    ) -> int:
+        if key is None:
+            key = event_key(event)
+        index = self._count
+        self._count += 1
+        # Both payloads are written as received from the daemon, never re-serialized.
+        self._events_fp.write(raw_event + b"\n")
+        if raw_inspect is not None:
+            envelope = json_dumps(
+                {
+                    "event_index": index,
+                    "timeNano": event.get("timeNano"),
+                    "id": event.get("Actor", {}).get("ID", ""),
+                    "action": event.get("Action", ""),
+                }
+            )
+            self._inspects_fp.write(envelope[:-1] + b',"inspect":' + raw_inspect + b"}\n")
+        self._queue.append((index, key))
+        self._new.set()
+        return index
+
+    def close(self, keep: bool) -> None:
+        # The producer must have stopped; see stop_event_stream.
+        if self._closed:
+            return
+        self._closed = True
+        self._events_fp.close()
+        self._inspects_fp.close()
+        for path in self._paths:
+            if keep:
+                os.replace(partial_path(path), path)
+            else:
+                partial_path(path).unlink(missing_ok=True)
+
+    def fail(self, exc: BaseException) -> None:
+        self._error = exc
+        self._new.set()
+
+    def _drain(self) -> None:
+        while self._queue:
+            index, key = self._queue.popleft()
+            self._by_key.setdefault(key, []).append(index)
+
+    def _first_match(self, keys: Set[EventKey], start_index: int) -> Optional[int]:
+        found = None
+        for key in keys:
+            indices = self._by_key.get(key)
+            if not indices:
+                continue
+            pos = bisect_left(indices, start_index)
+            if pos < len(indices) and (found is None or indices[pos] < found):
+                found = indices[pos]
+        return found
 
     def wait_for(self, name: str, actions: List[str], start_index: int, timeout: float) -> int:
         deadline = time.time() + timeout
         name = name.lstrip("/")
-        action_set = {a.lower() for a in actions}
-        with self._cond:
-            while True:
-                for idx in range(start_index, len(self.events)):
-                    event = self.events[idx]
-                    actor = event.get("Actor", {})
-                    actor_name = actor.get("Attributes", {}).get("name", "").lstrip("/")
-                    if actor_name != name:
-                        continue
-                    action = event.get("Action", "").lower()
-                    if action in action_set:
-                        return idx + 1
-                remaining = deadline - time.time()
-                if remaining <= 0:
-                    raise TimeoutError(f"timeout waiting for {name} actions {actions}")
-                self._cond.wait(timeout=remaining)
+        keys = {(name, a.lower()) for a in actions}
+        while True:
+            # Read the error before draining: events appended ahead of a failure still match.
+            error = self._error
+            self._drain()
+            idx = self._first_match(keys, start_index)
+            if idx is not None:
+                return idx + 1
+            if error is not None:
+                raise RuntimeError(f"event stream failed while waiting for {name} actions {actions}") from error
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError(f"timeout waiting for {name} actions {actions}")
+            self._new.clear()
+            # Recheck after clearing so an append or fail() racing with clear() is not missed.
+            if not self._queue and self._error is None:
+                self._new.wait(timeout=remaining)
+
+
+@lru_cache(maxsize=None)
+def resolve_executable(cmd: str) -> str:
+    return shutil.which(cmd) or cmd
 
 
 def run_cmd(args: List[str], check: bool = True) -> subprocess.CompletedProcess:
-    return subprocess.run(args, check=check, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # An absolute executable path and close_fds=False let subprocess use posix_spawn
+    # instead of fork+exec. Descriptors opened by Python are non-inheritable anyway.
+    args = [resolve_executable(args[0])] + args[1:]
+    return subprocess.run(
+        args,
+        check=check,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=False,
+    )
+
 
+def _docker_request(conn: UnixHTTPConnection, path: str) -> Tuple[int, bytes]:
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    return resp.status, resp.read()
 
-def docker_inspect(container_id: str) -> Optional[Dict[str, Any]]:
+
+def docker_get(path: str) -> Tuple[int, bytes]:
+    conn = docker_conn()
     try:
-        output = subprocess.check_output(["docker", "inspect", container_id], stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
-        return None
+        try:
+            return _docker_request(conn, path)
+        except (http.client.BadStatusLine, ConnectionError):
+            # The daemon may drop an idle keep-alive connection; reconnect once.
+            conn.close()
+            return _docker_request(conn, path)
+    except BaseException:
+        # A timeout or protocol error leaves the connection mid-request; reset it
+        # so the next call on this thread reconnects.
+        conn.close()
+        raise
+
+
+def docker_inspect(container_id: str) -> Optional[bytes]:
+    # The body is only copied into the dump, so it is returned unparsed.
     try:
-        data = json.loads(output.decode("utf-8"))
-    except json.JSONDecodeError:
+        status, body = docker_get(f"/containers/{container_id}/json")
+    except (OSError, http.client.HTTPException):
         return None
-    if not data:
+    body = body.strip()
+    if status != 200 or not body.startswith(b"{"):
         return None
-    return data[0]
+    return body
+
+
+class InspectCache:
+    def __init__(self, pool: ThreadPoolExecutor, ttl: float, inspect_all: bool) -> None:
+        self.pool = pool
+        self.ttl = ttl
+        self.inspect_all = inspect_all
+        self._entries: Dict[str, Tuple[float, Future]] = {}
+
+    def get(self, container_id: str, action: str) -> Optional[Future]:
+        base_action = action.split(":", 1)[0].strip()
+        if not self.inspect_all and base_action.startswith(SKIP_INSPECT_PREFIX):
+            return None
+        now = time.monotonic()
+        if base_action not in REFRESH_ACTIONS:
+            cached = self._entries.get(container_id)
+            if cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+        future = self.pool.submit(docker_inspect, container_id)
+        if base_action == "destroy":
+            self._entries.pop(container_id, None)
+        else:
+            self._entries[container_id] = (now, future)
+        return future
 
 
 def cleanup_labeled(label: str) -> None:
     result = run_cmd(["docker", "ps", "-a", "-q", "--filter", f"label={label}"], check=False)
-    ids = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+    ids = [line.strip().decode() for line in result.stdout.splitlines() if line.strip()]
     if not ids:
         return
     run_cmd(["docker", "rm", "-f"] + ids, check=False)
@@ -102,107 +309,226 @@ def normalize_command(command: Any) -> List[str]:
     return [str(command)]
 
 
-def start_event_stream(label: str, recorder: EventRecorder, stop_event: threading.Event) -> subprocess.Popen:
-    proc = subprocess.Popen(
-        [
-            "docker",
-            "events",
-            "--format",
-            "{{json .}}",
-            "--filter",
-            "type=container",
-            "--filter",
-            f"label={label}",
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,
-    )
+# The events socket and the loop thread reading it.
+EventStream = Tuple[socket.socket, threading.Thread]
 
-    def reader() -> None:
-        if proc.stdout is None:
-            return
-        for line in proc.stdout:
-            if stop_event.is_set():
-                break
+
+def open_event_socket(label: str) -> Tuple[socket.socket, bytes]:
+    filters = json.dumps({"type": ["container"], "label": [label]})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Bound the handshake so an unresponsive daemon cannot hang the capture;
+    # start_event_stream switches the socket to non-blocking afterwards.
+    sock.settimeout(DOCKER_TIMEOUT)
+    try:
+        sock.connect(docker_socket_path())
+        # HTTP/1.0 keeps the daemon from chunk-encoding the stream, so the body is
+        # plain newline-delimited JSON that can be split straight off the socket.
+        request = f"GET /events?{urlencode({'filters': filters})} HTTP/1.0\r\nHost: docker\r\n\r\n"
+        sock.sendall(request.encode("ascii"))
+        head = b""
+        while b"\r\n\r\n" not in head:
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise RuntimeError("docker events: connection closed before response")
+            head += chunk
+        head, body = head.split(b"\r\n\r\n", 1)
+        status_line = head.split(b"\r\n", 1)[0]
+        parts = status_line.split()
+        if len(parts) < 2 or parts[1] != b"200":
+            raise RuntimeError(f"docker events failed: {status_line!r}")
+    except BaseException:
+        sock.close()
+        raise
+    return sock, body
+
+
+def start_event_stream(
+    label: str,
+    recorder: EventRecorder,
+    stop_event: threading.Event,
+    inspect_all: bool = False,
+) -> EventStream:
+    sock, buf = open_event_socket(label)
+    sock.setblocking(False)
+    # Inspect workers poke this pair when a future completes to wake the loop.
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+    wake_w.setblocking(False)
+
+    def wake(_future: Future) -> None:
+        try:
+            wake_w.send(b"\0")
+        except OSError:
+            # Either a wakeup is already pending or the loop has exited.
+            pass
+
+    pool = ThreadPoolExecutor(max_workers=INSPECT_WORKERS)
+    cache = InspectCache(pool, INSPECT_TTL, inspect_all)
+    pending: Deque[Tuple[Dict[str, Any], bytes, EventKey, Optional[Future]]] = deque()
+
+    def ingest(lines: List[bytes]) -> None:
+        for line in lines:
             line = line.strip()
             if not line:
                 continue
             try:
-                event = json.loads(line)
+                event = json_loads(line)
             except json.JSONDecodeError:
                 continue
+            if not isinstance(event, dict):
+                continue
+            # Normalize once here; the cache and the recorder both reuse the key.
+            key = event_key(event)
             container_id = event.get("Actor", {}).get("ID", "")
-            inspect = docker_inspect(container_id) if container_id else None
-            recorder.append(event, inspect)
-
-    thread = threading.Thread(target=reader, daemon=True)
+            future = cache.get(container_id, key[1]) if container_id else None
+            if future is not None:
+                future.add_done_callback(wake)
+            pending.append((event, line, key, future))
+
+    def hand_over(wait: bool) -> None:
+        # Hand events over in arrival order as their inspects complete.
+        while pending and (wait or pending[0][3] is None or pending[0][3].done()):
+            event, line, key, future = pending.popleft()
+            recorder.append(event, line, future.result() if future is not None else None, key)
+
+    def loop() -> None:
+        nonlocal buf
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(wake_r, selectors.EVENT_READ)
+        closed = False
+        try:
+            *lines, buf = buf.split(b"\n")
+            ingest(lines)
+            while not closed and not stop_event.is_set():
+                hand_over(wait=False)
+                for selected, _ in selector.select():
+                    if selected.fileobj is wake_r:
+                        wake_r.recv(4096)
+                        continue
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        closed = True
+                        break
+                    buf += chunk
+                    *lines, buf = buf.split(b"\n")
+                    ingest(lines)
+            # Events whose inspects are still in flight are kept either way.
+            hand_over(wait=True)
+            if closed and not stop_event.is_set():
+                # Only a shutdown from the main thread is expected to end the stream.
+                raise RuntimeError("docker closed the event stream")
+        except BaseException as exc:
+            recorder.fail(exc)
+        finally:
+            selector.close()
+            pool.shutdown(wait=False)
+            sock.close()
+            wake_r.close()
+            wake_w.close()
+
+    # A single selector loop reads the stream and resolves inspects; only the
+    # blocking docker round-trips run on the pool.
+    thread = threading.Thread(target=loop, daemon=True)
     thread.start()
-    return proc
+    return sock, thread
+
+
+def stop_event_stream(stream: EventStream) -> None:
+    sock, thread = stream
+    # Shutting down makes the socket readable at EOF; the loop closes it on exit.
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    # Once the loop has exited nothing else appends to the recorder.
+    thread.join()
 
 
 def wait_for_actions(recorder: EventRecorder, name: str, actions: List[str], cursor: int) -> int:
     return recorder.wait_for(name, actions, cursor, timeout=10.0)
 
 
+def _do_sleep(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    time.sleep(float(step.get("seconds", 1)))
+    return cursor
+
+
+def _do_run(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    name = step["name"]
+    image = step["image"]
+    cmd = ["docker", "run", "-d", "--name", name, "--label", "healthmon.test=1", "--label", scenario_label]
+    for label in step.get("labels", []) or []:
+        cmd.extend(["--label", str(label)])
+    cmd.append(image)
+    cmd.extend(normalize_command(step.get("command")))
+    run_cmd(cmd)
+    cursor = wait_for_actions(recorder, name, ["create"], cursor)
+    cursor = wait_for_actions(recorder, name, ["start"], cursor)
+    return cursor
+
+
+def _do_start(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    name = step["name"]
+    run_cmd(["docker", "start", name])
+    return wait_for_actions(recorder, name, ["start"], cursor)
+
+
+def _do_stop(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    name = step["name"]
+    run_cmd(["docker", "stop", name])
+    return wait_for_actions(recorder, name, ["stop", "die"], cursor)
+
+
+def _do_kill(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    name = step["name"]
+    signal_name = str(step.get("signal", "9"))
+    run_cmd(["docker", "kill", "--signal", signal_name, name])
+    return wait_for_actions(recorder, name, ["kill"], cursor)
+
+
+def _do_restart(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    name = step["name"]
+    run_cmd(["docker", "restart", name])
+    return wait_for_actions(recorder, name, ["restart", "start"], cursor)
+
+
+def _do_rename(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    old = step["from"]
+    new = step["to"]
+    run_cmd(["docker", "rename", old, new])
+    return wait_for_actions(recorder, new, ["rename"], cursor)
+
+
+def _do_rm(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
+    name = step["name"]
+    args = ["docker", "rm"]
+    if step.get("force", True):
+        args.append("-f")
+    args.append(name)
+    run_cmd(args)
+    return wait_for_actions(recorder, name, ["destroy", "remove", "rm"], cursor)
+
+
+_ACTIONS: Dict[str, Callable[[Dict[str, Any], str, EventRecorder, int], int]] = {
+    "sleep": _do_sleep,
+    "run": _do_run,
+    "start": _do_start,
+    "stop": _do_stop,
+    "kill": _do_kill,
+    "restart": _do_restart,
+    "rename": _do_rename,
+    "rm": _do_rm,
+}
+
+
 def run_action(step: Dict[str, Any], scenario_label: str, recorder: EventRecorder, cursor: int) -> int:
     action = str(step.get("action", "")).lower()
-    if action == "sleep":
-        time.sleep(float(step.get("seconds", 1)))
-        return cursor
-
-    if action == "run":
-        name = step["name"]
-        image = step["image"]
-        cmd = ["docker", "run", "-d", "--name", name, "--label", "healthmon.test=1", "--label", scenario_label]
-        for label in step.get("labels", []) or []:
-            cmd.extend(["--label", str(label)])
-        cmd.append(image)
-        cmd.extend(normalize_command(step.get("command")))
-        run_cmd(cmd)
-        cursor = wait_for_actions(recorder, name, ["create"], cursor)
-        cursor = wait_for_actions(recorder, name, ["start"], cursor)
-        return cursor
-
-    if action == "start":
-        name = step["name"]
-        run_cmd(["docker", "start", name])
-        return wait_for_actions(recorder, name, ["start"], cursor)
-
-    if action == "stop":
-        name = step["name"]
-        args = ["docker", "stop", name]
-        run_cmd(args)
-        return wait_for_actions(recorder, name, ["stop", "die"], cursor)
-
-    if action == "kill":
-        name = step["name"]
-        signal_name = str(step.get("signal", "9"))
-        run_cmd(["docker", "kill", "--signal", signal_name, name])
-        return wait_for_actions(recorder, name, ["kill"], cursor)
-
-    if action == "restart":
-        name = step["name"]
-        run_cmd(["docker", "restart", name])
-        return wait_for_actions(recorder, name, ["restart", "start"], cursor)
-
-    if action == "rename":
-        old = step["from"]
-        new = step["to"]
-        run_cmd(["docker", "rename", old, new])
-        return wait_for_actions(recorder, new, ["rename"], cursor)
-
-    if action == "rm":
-        name = step["name"]
-        args = ["docker", "rm"]
-        if step.get("force", True):
-            args.append("-f")
-        args.append(name)
-        run_cmd(args)
-        return wait_for_actions(recorder, name, ["destroy", "remove", "rm"], cursor)
-
-    raise ValueError(f"unsupported action: {action}")
+    try:
+        handler = _ACTIONS[action]
+    except KeyError:
+        raise ValueError(f"unsupported action: {action}") from None
+    return handler(step, scenario_label, recorder, cursor)
 
 
 def load_scenario(path: Path) -> List[Dict[str, Any]]:
@@ -214,17 +540,11 @@ def load_scenario(path: Path) -> List[Dict[str, Any]]:
     return steps
 
 
-def write_jsonl(path: Path, items: List[Any]) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as handle:
-        for item in items:
-            handle.write(json.dumps(item) + "\n")
-
-
 def main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("--scenario-dir", default="testdata/scenarios")
     parser.add_argument("--dump-dir", default="testdata/dumps")
+    parser.add_argument("--inspect-all", action="store_true")
     args = parser.parse_args()
 
     scenario_dir = Path(args.scenario_dir)
@@ -234,10 +554,16 @@ def main() -> int:
         print(f"no scenarios found in {scenario_dir}", file=sys.stderr)
         return 1
 
-    if not shutil_which("docker"):
+    if not shutil.which("docker"):
         print("docker is required", file=sys.stderr)
         return 1
 
+    try:
+        docker_socket_path()
+    except RuntimeError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+
     stop_event = threading.Event()
 
     def handle_signal(_sig, _frame):
@@ -255,43 +581,33 @@ def main() -> int:
 
         cleanup_labeled("healthmon.test=1")
 
-        recorder = EventRecorder()
-        proc = start_event_stream("healthmon.test=1", recorder, stop_event)
+        events_path = dump_dir / f"{scenario_name}.events.jsonl"
+        inspects_path = dump_dir / f"{scenario_name}.inspects.jsonl"
+        recorder = EventRecorder(events_path, inspects_path)
+        stream: Optional[EventStream] = None
         cursor = 0
+        completed = False
         try:
+            stream = start_event_stream("healthmon.test=1", recorder, stop_event, args.inspect_all)
             steps = load_scenario(scenario_path)
             for step in steps:
                 if stop_event.is_set():
                     break
                 cursor = run_action(step, scenario_label, recorder, cursor)
+            completed = True
         finally:
             stop_event.set()
-            if proc.poll() is None:
-                proc.terminate()
-                try:
-                    proc.wait(timeout=2)
-                except subprocess.TimeoutExpired:
-                    proc.kill()
+            if stream is not None:
+                stop_event_stream(stream)
             cleanup_labeled("healthmon.test=1")
             stop_event.clear()
+            # A failed scenario leaves the previous dumps untouched.
+            recorder.close(keep=completed)
 
-        events_path = dump_dir / f"{scenario_name}.events.jsonl"
-        inspects_path = dump_dir / f"{scenario_name}.inspects.jsonl"
-        write_jsonl(events_path, recorder.events)
-        write_jsonl(inspects_path, [record.__dict__ for record in recorder.inspects])
         print(f"wrote {events_path} and {inspects_path}")
 
     return 0
 
 
-def shutil_which(cmd: str) -> Optional[str]:
-    path = os.environ.get("PATH", "")
-    for entry in path.split(os.pathsep):
-        candidate = Path(entry) / cmd
-        if candidate.exists() and os.access(candidate, os.X_OK):
-            return str(candidate)
-    return None
-
-
 if __name__ == "__main__":
     raise SystemExit(main())